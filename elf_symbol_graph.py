@@ -8,6 +8,7 @@
 # This code is in the public domain
 #-------------------------------------------------------------------------------
 from __future__ import print_function
+import argparse
 import sys
 
 # If pyelftools is not installed, the example can also run from the root or
@@ -19,9 +20,14 @@ from elftools.elf.sections import NoteSection
 from elftools.common.py3compat import bytes2hex
 from elftools.elf.sections import SymbolTableSection
 from elftools.elf.relocation import RelocationSection
+from elftools.elf.constants import SH_FLAGS
 
+import bisect
+import fnmatch
 import networkx as nx
+import os
 import pathlib
+import time
 import arpy
 
 IGNORE_SECTIONS = [".group", ".debug_macro", ".debug_info", ".debug_abbrev", ".debug_loc", ".debug_aranges", ".debug_frame", ".debug_line", ".debug_ranges", ".comment", ".debug_str", ".riscv.attributes", ".debug_rnglists", ".debug_loclists"]
@@ -32,6 +38,15 @@ symbol_to_node_name = {
     
 }
 
+def register_node_name(key, source_symbol_name):
+    """Remember the node a (name, size) key belongs to. Keys claimed by two
+    different nodes can't be told apart in the elf and map to None."""
+    if key in symbol_to_node_name:
+        if symbol_to_node_name[key] != source_symbol_name:
+            symbol_to_node_name[key] = None # conflict
+    else:
+        symbol_to_node_name[key] = source_symbol_name
+
 def symbol_to_node(filename, symbol):
     bind = symbol["st_info"]["bind"]
     attrs = {"label": symbol.name, "size_bytes": symbol["st_size"]}
@@ -47,12 +62,7 @@ def symbol_to_node(filename, symbol):
     elif bind == "STB_WEAK":
         attrs["bind"] = "weak"
         source_symbol_name = f"{symbol.name}"
-    key = (symbol.name, symbol["st_size"])
-    if key in symbol_to_node_name:
-        if symbol_to_node_name[key] != source_symbol_name:
-            symbol_to_node_name[key] = None # conflict
-    else:
-        symbol_to_node_name[key] = source_symbol_name
+    register_node_name((symbol.name, symbol["st_size"]), source_symbol_name)
     if symbol.name == "gc_mark_subtree":
         print(symbol.name, symbol["st_size"], source_symbol_name)
     return source_symbol_name, attrs
@@ -79,7 +89,12 @@ def get_string_node(filename, data, offset):
     attrs["size_bytes"] = end - offset
     return f"{filename}:{key}", attrs
 
-def process_object_file(f, filename, graph, discarded=set()):
+def process_object_file(f, filename, graph, discarded=set(), keep=None):
+    """Add the symbols and relocations of one object file to graph.
+
+    When keep is given only sections whose names are in it and the sections
+    referencing them are read. References out of kept sections still add
+    the referenced node."""
     ef = ELFFile(f)
     # Load undefined symbols
     symtab = ef.get_section_by_name(".symtab")
@@ -87,6 +102,13 @@ def process_object_file(f, filename, graph, discarded=set()):
         return
     symbols = list(symtab.iter_symbols())
     sections = list(ef.iter_sections())
+
+    # Relocations out of a section that isn't kept only matter when they
+    # point into one that is.
+    def targets_kept(r):
+        dest_section_index = symbols[r["r_info_sym"]]["st_shndx"]
+        return isinstance(dest_section_index, int) and sections[dest_section_index].name in keep
+
     symbols_by_section = {}
     for symbol_index, s in enumerate(symbols):
         si = s["st_shndx"]
@@ -97,11 +119,16 @@ def process_object_file(f, filename, graph, discarded=set()):
                 related_section = sections[int(si)]
                 if (related_section.name, related_section.header["sh_size"]) in discarded:
                     continue
-            node_name, node_attrs = symbol_to_node(filename, s)
-            if related_section:
-                node_attrs["section"] = related_section.name
-                node_attrs["prelink"] = related_section.data().hex(" ", 4)
-            graph.add_node(node_name, **node_attrs)
+                kept = keep is None or related_section.name in keep
+            else:
+                related_section = None
+                kept = keep is None or "COMMON" in keep
+            if kept:
+                node_name, node_attrs = symbol_to_node(filename, s)
+                if related_section:
+                    node_attrs["section"] = related_section.name
+                    node_attrs["prelink"] = related_section.data().hex(" ", 4)
+                graph.add_node(node_name, **node_attrs)
         if si not in symbols_by_section:
             symbols_by_section[si] = []
         symbols_by_section[si].append(s)
@@ -113,6 +140,8 @@ def process_object_file(f, filename, graph, discarded=set()):
             
         if (sect.name, sect.header["sh_size"]) in discarded:
             continue
+        if keep is not None and not isinstance(sect, RelocationSection) and sect.name not in keep:
+            continue
         if i in symbols_by_section:
             if sect.name.startswith(".sdata"):
                 other_names = {}
@@ -154,6 +183,10 @@ def process_object_file(f, filename, graph, discarded=set()):
 
             if (source_section.name, source_section.header["sh_size"]) in discarded:
                 continue
+            relocations = list(sect.iter_relocations())
+            incoming_only = keep is not None and source_section.name not in keep
+            if incoming_only and not any(targets_kept(r) for r in relocations):
+                continue
 
             # Node name from symbol
             for s in symbols_by_section[source_section_index]:
@@ -169,9 +202,11 @@ def process_object_file(f, filename, graph, discarded=set()):
                 section_attrs["section"] = source_section.name
                 graph.add_node(source_symbol_name, **section_attrs)
 
-            for r in sect.iter_relocations():
+            for r in relocations:
                 if r["r_info_sym"] == 0:
                     continue
+                if incoming_only and not targets_kept(r):
+                    continue
                 s = symbols[r["r_info_sym"]]
                 dest_section_index = s["st_shndx"]
 
@@ -210,15 +245,84 @@ def process_object_file(f, filename, graph, discarded=set()):
 
                 graph.add_edge(source_symbol_name, dest_symbol_name, **edge_attrs)
 
-def process_map_file(filename, graph):
+class Filters:
+    """Which parts of the firmware to ingest. Empty lists match everything.
+
+    A placed input section is ingested when it passes every kind of filter
+    given: it overlaps one of the address ranges, its input or output section
+    name matches one of the section globs, its source matches one of the path
+    globs and it contains a symbol matching one of the symbol globs."""
+    def __init__(self, address_ranges=(), sections=(), paths=(), symbols=()):
+        self.address_ranges = list(address_ranges)
+        self.sections = list(sections)
+        self.paths = list(paths)
+        self.symbols = list(symbols)
+        self.allocated_sections = set()
+        self.symbol_addresses = []
+
+    def __bool__(self):
+        return bool(self.address_ranges or self.sections or self.paths or self.symbols)
+
+    def load_elf(self, elf_filename):
+        """Find the output sections that take up memory and the addresses of
+        the symbols matching the symbol globs."""
+        addresses = set()
+        with open(elf_filename, 'rb') as f:
+            ef = ELFFile(f)
+            # Debug and attribute sections are listed in the map at offsets
+            # from 0x0 which look like addresses.
+            self.allocated_sections = {s.name for s in ef.iter_sections() if s["sh_flags"] & SH_FLAGS.SHF_ALLOC}
+            thumb = ef["e_machine"] == "EM_ARM"
+            symtab = ef.get_section_by_name(".symtab")
+            if symtab and self.symbols:
+                for s in symtab.iter_symbols():
+                    # Absolute symbols are linker script markers like _etext
+                    if not s.name or s["st_shndx"] in ("SHN_UNDEF", "SHN_ABS"):
+                        continue
+                    if any(fnmatch.fnmatchcase(s.name, g) for g in self.symbols):
+                        address = s["st_value"]
+                        if thumb and s["st_info"]["type"] == "STT_FUNC":
+                            # Clear the Thumb bit
+                            address &= ~1
+                        addresses.add(address)
+        self.symbol_addresses = sorted(addresses)
+
+    def wants(self, output_section, input_section, address, size, source):
+        end = address + size
+        if self.address_ranges and not any(start < end and address < stop for start, stop in self.address_ranges):
+            return False
+        if self.sections and not any(fnmatch.fnmatchcase(output_section, g) or fnmatch.fnmatchcase(input_section, g) for g in self.sections):
+            return False
+        if self.paths and not any(fnmatch.fnmatchcase(source, g) for g in self.paths):
+            return False
+        if self.symbols:
+            i = bisect.bisect_left(self.symbol_addresses, address)
+            if i == len(self.symbol_addresses) or self.symbol_addresses[i] >= end:
+                return False
+        return True
+
+def parse_map_file(filename, filters=None):
+    """Parse a map file into the list of inputs the linker loaded.
+
+    Each entry is (path, members, discarded, keep) where members is the set
+    of archive members pulled in (None for plain .o files) and keep is the
+    set of section names to ingest (None for all of them). With filters, the
+    placement of every input section in the memory map decides which objects
+    and sections are worth opening at all."""
     path = pathlib.Path(filename)
     top = path.parent.parent
+    loads = []
+    if filters:
+        filters.load_elf(filename[:-4])
     with open(filename, "r") as f:
         in_archive_include = 0
         in_discarded_sections = 0
+        in_memory_map = False
         section_name = None
+        output_section = None
         included = {}
         discarded = {}
+        placed = {}
         for line in f:
             if line == "Archive member included to satisfy reference by file (symbol)\n":
                 in_archive_include = 2
@@ -278,36 +382,112 @@ def process_map_file(filename, graph):
                         discarded[path] = set()
                     discarded[path].add((section_name, size))
 
+            if line == "Linker script and memory map\n":
+                in_memory_map = True
+                continue
+            if in_memory_map and filters and not line.startswith("LOAD"):
+                split = line.split()
+                if not split:
+                    continue
+                if line[0] != " ":
+                    output_section = split[0]
+                    section_name = None
+                    continue
+                if not line.startswith("  ") and len(split) == 1:
+                    # Other info is on the next line
+                    section_name = split[0]
+                    continue
+                if not line.startswith("  ") and len(split) == 4:
+                    section_name = split[0]
+                    split = split[1:]
+                if section_name is None or len(split) != 3 or not split[0].startswith("0x"):
+                    section_name = None
+                    continue
+                address = int(split[0], 0)
+                size = int(split[1], 0)
+                filename = split[2]
+                name = section_name
+                section_name = None
+                if size == 0 or output_section not in filters.allocated_sections:
+                    continue
+
+                if ".a(" in filename:
+                    archive, obj = filename.split("(")
+                    obj = obj.strip(")")
+                    archive = pathlib.Path(archive)
+                    if not archive.is_absolute():
+                        archive = top / archive
+                    archive = archive.resolve()
+                    if not filters.wants(output_section, name, address, size, f"{archive}:{obj}"):
+                        continue
+                    if archive not in placed:
+                        placed[archive] = {}
+                    if obj not in placed[archive]:
+                        placed[archive][obj] = set()
+                    placed[archive][obj].add(name)
+                else:
+                    path = pathlib.Path(filename)
+                    if not path.is_absolute():
+                        path = top / path
+                    path = path.resolve()
+                    if not filters.wants(output_section, name, address, size, str(path)):
+                        continue
+                    if path not in placed:
+                        placed[path] = set()
+                    placed[path].add(name)
+
             if line.startswith("LOAD"):
                 fn = pathlib.Path(line[5:].strip())
                 if not fn.is_absolute():
                     fn = top / fn
                 fn = fn.resolve()
                 if fn.suffix == ".a":
-                    with arpy.Archive(fn) as ar:
-                        if fn not in included:
-                            continue
-                        else:
-                            print(f"{fn}")
-                        for ofn in ar.namelist():
-                            if ofn not in included[fn]:
-                                continue
-                            obj = ofn.decode("utf-8")
-                            print(f"\t{obj}")
-                            d = discarded.get(fn, {obj:set()}).get(obj, set())
-                            with ar.open(ofn) as f2:
-                                process_object_file(f2, str(fn) + ":" + obj, graph, d)
+                    if fn not in included:
+                        continue
+                    loads.append((fn, included[fn], discarded.get(fn, {}), None))
                 elif fn.suffix == ".o":
-                    try:
-                        d = discarded.get(fn, set())
-                        print(fn)
-                        with open(fn, 'rb') as f2:
-                            process_object_file(f2, str(fn), graph, d)
-                    except BaseException as e:
-                        print(e)
-                        raise
-
-def process_elf_file(filename, graph):
+                    loads.append((fn, None, discarded.get(fn, set()), None))
+    if not filters:
+        return loads
+
+    wanted = []
+    for fn, members, d, _ in loads:
+        if fn not in placed:
+            continue
+        keep = placed[fn]
+        if members is not None:
+            members = {m for m in members if m.decode("utf-8") in keep}
+        wanted.append((fn, members, d, keep))
+    return wanted
+
+def load_input(fn, members, discarded, keep, graph):
+    """Process one loaded input (an object file or archive) into graph."""
+    if members is not None:
+        with arpy.Archive(fn) as ar:
+            print(f"{fn}")
+            for ofn in ar.namelist():
+                if ofn not in members:
+                    continue
+                obj = ofn.decode("utf-8")
+                print(f"\t{obj}")
+                d = discarded.get(obj, set())
+                k = keep[obj] if keep is not None else None
+                with ar.open(ofn) as f2:
+                    process_object_file(f2, str(fn) + ":" + obj, graph, d, k)
+    else:
+        try:
+            print(fn)
+            with open(fn, 'rb') as f2:
+                process_object_file(f2, str(fn), graph, discarded, keep)
+        except BaseException as e:
+            print(e)
+            raise
+
+def process_map_file(filename, graph, filters=None):
+    for fn, members, discarded, keep in parse_map_file(filename, filters):
+        load_input(fn, members, discarded, keep, graph)
+
+def process_elf_file(filename, graph, filters=None):
     """Process an elf file to get addresses of symbols"""
     with open(filename, 'rb') as f:
         ef = ELFFile(f)
@@ -316,7 +496,18 @@ def process_elf_file(filename, graph):
         if not symtab:
             return
         sections = list(ef.iter_sections())
+        section_data = {}
         symbols = list(symtab.iter_symbols())
+        # Filtered out objects never registered their symbols so conflicts
+        # with them have to be found in the elf instead.
+        duplicated = set()
+        if filters:
+            seen = set()
+            for s in symbols:
+                key = (s.name, s["st_size"])
+                if key in seen:
+                    duplicated.add(key)
+                seen.add(key)
         for symbol_index, s in enumerate(symbols):
             if not s.name or s["st_size"] == 0 or s["st_info"]["bind"] == "STB_WEAK":
                 # print("skip", s.name, s.entry)
@@ -326,7 +517,12 @@ def process_elf_file(filename, graph):
                 continue
             # print(s.name, hex(s["st_value"]), s.entry)
             key = (s.name, s["st_size"])
+            if key not in symbol_to_node_name:
+                # Filtered out of the graph
+                continue
             source_symbol_name = symbol_to_node_name[key]
+            if key in duplicated:
+                source_symbol_name = None
             if source_symbol_name is None:
                 print("conflict", s.name)
                 continue
@@ -336,21 +532,18 @@ def process_elf_file(filename, graph):
             node_info["address"] = symbol_address
 
             section = sections[s["st_shndx"]]
+            if s["st_shndx"] not in section_data:
+                section_data[s["st_shndx"]] = section.data()
             section_address = section["sh_addr"]
             start = symbol_address - section_address
             size = s["st_size"]
-            node_info["postlink"] = section.data()[start:start+size].hex(" ", 4)
+            node_info["postlink"] = section_data[s["st_shndx"]][start:start+size].hex(" ", 4)
 
-if __name__ == '__main__':
-    graph = nx.DiGraph()
-    if sys.argv[1].endswith(".o"):
-        for filename in sys.argv[1:]:
-            with open(filename, 'rb') as f:
-                    process_object_file(f, filename, graph)
-    elif sys.argv[1].endswith(".map"):
-        process_map_file(sys.argv[1], graph)
-        process_elf_file(sys.argv[1][:-4], graph)
+def write_graph(graph, filename):
+    """Weight edges by the in degree of their target and write a gexf file.
 
+    The file is written next to its destination and then moved over it so
+    readers never see a partially written graph."""
     for node in graph.nodes():
         in_degree = graph.in_degree(node)
         if in_degree == 0:
@@ -361,7 +554,137 @@ if __name__ == '__main__':
             for _, _, data in graph.in_edges(node, data=True):
                 data["weight"] = w
 
-    nx.write_gexf(graph, "test.gexf")
+    tmp = str(filename) + ".tmp"
+    nx.write_gexf(graph, tmp)
+    os.replace(tmp, filename)
+
+def _mtime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def ingest_inputs(loads, mtimes, cache):
+    """Parse the inputs that changed since they were cached.
+
+    Each input gets its own graph, cached along with its mtime and the
+    symbol names it registered."""
+    for fn, members, discarded, keep in loads:
+        cached = cache.get(fn)
+        if cached and cached[0] == mtimes[fn] and cached[1] == (members, discarded, keep):
+            continue
+        symbol_to_node_name.clear()
+        subgraph = nx.DiGraph()
+        load_input(fn, members, discarded, keep, subgraph)
+        cache[fn] = (mtimes[fn], (members, discarded, keep), subgraph, dict(symbol_to_node_name))
+    for fn in set(cache) - set(mtimes):
+        del cache[fn]
+
+def merge_inputs(loads, cache):
+    """Stitch the cached input graphs and symbol names back together."""
+    graph = nx.DiGraph()
+    symbol_to_node_name.clear()
+    for fn, *_ in loads:
+        _, _, subgraph, names = cache[fn]
+        graph.update(subgraph)
+        for key, source_symbol_name in names.items():
+            register_node_name(key, source_symbol_name)
+    return graph
+
+def watch(map_filename, output="test.gexf", interval=0.1, filters=None):
+    """Rebuild output whenever the map and elf change.
+
+    Inputs that change during a build are parsed into the cache straight
+    away but only published once the link finishes, so each publish mostly
+    stitches cached graphs together before resolving the elf addresses."""
+    if not map_filename.endswith(".map"):
+        raise ValueError(f"{map_filename} is not a .map file")
+    elf_filename = map_filename[:-4]
+    loads = []
+    map_mtime = None
+    last_snapshot = None
+    last_linked = None
+    cache = {}
+    try:
+        while True:
+            snapshot = [_mtime(map_filename), _mtime(elf_filename)]
+            snapshot.extend(_mtime(fn) for fn, *_ in loads)
+            if snapshot == last_snapshot:
+                time.sleep(interval)
+                continue
+            # Wait for the linker to finish writing before reading anything.
+            time.sleep(interval)
+            if snapshot[:2] != [_mtime(map_filename), _mtime(elf_filename)]:
+                continue
+            last_snapshot = snapshot
+            if None in snapshot[:2]:
+                continue
+
+            start = time.monotonic()
+            try:
+                if snapshot[0] != map_mtime:
+                    loads = parse_map_file(map_filename, filters)
+                    map_mtime = snapshot[0]
+                mtimes = {fn: _mtime(fn) for fn, *_ in loads}
+                last_snapshot = snapshot[:2] + [mtimes[fn] for fn, *_ in loads]
+                ingest_inputs(loads, mtimes, cache)
+                if snapshot[:2] == last_linked:
+                    # Only inputs changed. Wait for the link to publish them
+                    # with matching addresses.
+                    continue
+
+                graph = merge_inputs(loads, cache)
+                process_elf_file(elf_filename, graph, filters)
+                write_graph(graph, output)
+                last_linked = snapshot[:2]
+            except Exception as e:
+                # Most likely a build in progress. Try again on the next change.
+                print("rebuild failed:", repr(e))
+            else:
+                print(graph.number_of_nodes(), "nodes", graph.number_of_edges(), "edges",
+                      f"in {time.monotonic() - start:.2f}s")
+    except KeyboardInterrupt:
+        tmp = pathlib.Path(str(output) + ".tmp")
+        if tmp.exists():
+            tmp.unlink()
+
+def address_range(value):
+    start, stop = value.split("-")
+    return int(start, 0), int(stop, 0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="a firmware.elf.map file or .o files")
+    parser.add_argument("--watch", action="store_true", help="rebuild test.gexf whenever the build changes")
+    parser.add_argument("--address", action="append", default=[], type=address_range, metavar="START-END", help="only ingest sections overlapping this address range")
+    parser.add_argument("--section", action="append", default=[], metavar="GLOB", help="only ingest input or output sections matching this glob and the sections in the same object referencing them")
+    parser.add_argument("--path", action="append", default=[], metavar="GLOB", help="only ingest objects whose path matches this glob")
+    parser.add_argument("--symbol", action="append", default=[], metavar="GLOB", help="only ingest sections containing a symbol matching this glob")
+    args = parser.parse_args()
+    filters = Filters(args.address, args.section, args.path, args.symbol)
+
+    if args.watch:
+        if not args.inputs[0].endswith(".map"):
+            parser.error("--watch needs a firmware.elf.map file")
+        watch(args.inputs[0], filters=filters)
+        sys.exit()
+
+    if not args.inputs[0].endswith(".map") and (args.address or args.section or args.symbol):
+        parser.error("--address, --section and --symbol need a firmware.elf.map file")
+
+    graph = nx.DiGraph()
+    if args.inputs[0].endswith(".o"):
+        # Without a map there are no addresses so only paths can be filtered.
+        for filename in args.inputs:
+            if filters.paths and not any(fnmatch.fnmatchcase(filename, g) for g in filters.paths):
+                continue
+            with open(filename, 'rb') as f:
+                    process_object_file(f, filename, graph)
+    elif args.inputs[0].endswith(".map"):
+        process_map_file(args.inputs[0], graph, filters)
+        process_elf_file(args.inputs[0][:-4], graph, filters)
+
+    write_graph(graph, "test.gexf")
 
     print(graph.number_of_nodes(), "nodes")
     print(graph.number_of_edges(), "edges")
@@ -0,0 +1,254 @@
+import shutil
+import subprocess
+
+import networkx as nx
+import pytest
+
+import elf_symbol_graph
+from elf_symbol_graph import Filters, ingest_inputs, merge_inputs, parse_map_file, process_elf_file, process_object_file, symbol_to_node_name
+
+# Trimmed from an arm-none-eabi-ld map. Covers names long enough to wrap onto
+# the next line, an archive member, *fill*, COMMON, input section globs and
+# non-allocated sections that start back at 0x0.
+MAP = """\
+Archive member included to satisfy reference by file (symbol)
+
+lib/libgcc_extremely_long_name.a(_udivsi3.o)
+                              build/main.o (__aeabi_uidiv)
+
+Discarded input sections
+
+ .text          0x00000000        0x0 build/main.o
+ .text.unused_function_with_a_long_name
+                0x00000000       0x10 build/main.o
+
+Memory Configuration
+
+Name             Origin             Length             Attributes
+FLASH            0x00000000         0x00040000         xr
+RAM              0x20000000         0x00008000         xrw
+*default*        0x00000000         0xffffffff
+
+Linker script and memory map
+
+LOAD build/main.o
+LOAD build/gc.o
+LOAD lib/libgcc_extremely_long_name.a
+                0x00000000                __flash_start = ORIGIN (FLASH)
+
+.text           0x00000000       0x74
+ *(.text*)
+ .text.main     0x00000000       0x20 build/main.o
+                0x00000000                main
+ .text.gc_collect_with_a_long_name
+                0x00000020       0x40 build/gc.o
+                0x00000020                gc_collect_with_a_long_name
+ *fill*         0x00000060        0x4
+ .text          0x00000064       0x10 lib/libgcc_extremely_long_name.a(_udivsi3.o)
+                0x00000064                __aeabi_uidiv
+                0x00000074                _etext = .
+
+.bss            0x20000000       0x20
+ COMMON         0x20000000       0x20 build/gc.o
+                0x20000000                gc_heap
+
+.debug_info     0x00000000      0x300
+ *(.debug_info .gnu.linkonce.wi.*)
+ .debug_info    0x00000000      0x100 build/main.o
+ .debug_info    0x00000100      0x200 build/gc.o
+
+.ARM.attributes
+                0x00000000       0x2e
+ *(.ARM.attributes)
+ .ARM.attributes
+                0x00000000       0x2e build/main.o
+ .ARM.attributes
+                0x0000002e       0x2e build/gc.o
+"""
+
+@pytest.fixture(autouse=True)
+def clear_symbol_names():
+    symbol_to_node_name.clear()
+
+@pytest.fixture
+def map_file(tmp_path):
+    build = tmp_path / "build"
+    build.mkdir()
+    path = build / "firmware.elf.map"
+    path.write_text(MAP)
+    return path
+
+@pytest.fixture
+def top(tmp_path):
+    return tmp_path.resolve()
+
+def parse(map_file, monkeypatch, symbol_addresses=(), **kwargs):
+    # These normally come from the elf next to the map.
+    def load_elf(self, filename):
+        self.allocated_sections = {".text", ".bss"}
+        self.symbol_addresses = sorted(symbol_addresses)
+    monkeypatch.setattr(Filters, "load_elf", load_elf)
+    filters = Filters(**kwargs)
+    return {fn: keep for fn, _, _, keep in parse_map_file(str(map_file), filters)}
+
+def test_unfiltered(map_file, top):
+    loads = parse_map_file(str(map_file))
+    assert [fn for fn, *_ in loads] == [top / "build/main.o", top / "build/gc.o", top / "lib/libgcc_extremely_long_name.a"]
+    main, gc, lib = loads
+    assert main[1] is None
+    assert main[2] == {(".text", 0), (".text.unused_function_with_a_long_name", 0x10)}
+    assert main[3] is None
+    assert lib[1] == {b"_udivsi3.o"}
+
+def test_wrapped_section_name(map_file, monkeypatch, top):
+    assert parse(map_file, monkeypatch, sections=[".text.gc_*"]) == {
+        top / "build/gc.o": {".text.gc_collect_with_a_long_name"},
+    }
+
+def test_output_section_and_common(map_file, monkeypatch, top):
+    assert parse(map_file, monkeypatch, sections=[".bss"]) == {
+        top / "build/gc.o": {"COMMON"},
+    }
+
+def test_archive_member(map_file, monkeypatch, top):
+    monkeypatch.setattr(Filters, "load_elf", lambda self, filename: setattr(self, "allocated_sections", {".text"}))
+    loads = parse_map_file(str(map_file), Filters(paths=["*:_udivsi3.o"]))
+    assert loads == [(top / "lib/libgcc_extremely_long_name.a", {b"_udivsi3.o"}, {}, {"_udivsi3.o": {".text"}})]
+
+def test_unallocated_sections(map_file, monkeypatch, top):
+    assert parse(map_file, monkeypatch, address_ranges=[(0x0, 0x20)]) == {
+        top / "build/main.o": {".text.main"},
+    }
+    assert parse(map_file, monkeypatch, paths=["*/main.o"]) == {
+        top / "build/main.o": {".text.main"},
+    }
+
+@pytest.mark.parametrize("start, stop, expected", [
+    (0x00, 0x20, {"build/main.o"}),
+    (0x20, 0x21, {"build/gc.o"}),
+    (0x1f, 0x21, {"build/main.o", "build/gc.o"}),
+    # The fill isn't an input section
+    (0x60, 0x64, set()),
+    (0x74, 0x100, set()),
+])
+def test_address_boundaries(map_file, monkeypatch, top, start, stop, expected):
+    loads = parse(map_file, monkeypatch, address_ranges=[(start, stop)])
+    assert set(loads) == {top / fn for fn in expected}
+
+@pytest.mark.parametrize("address, expected", [
+    (0x00, {"build/main.o"}),
+    (0x1f, {"build/main.o"}),
+    # A symbol right after a section doesn't select it
+    (0x20, {"build/gc.o"}),
+    (0x64, {"lib/libgcc_extremely_long_name.a"}),
+    (0x74, set()),
+])
+def test_symbol_boundaries(map_file, monkeypatch, top, address, expected):
+    loads = parse(map_file, monkeypatch, symbol_addresses=[address], symbols=["*"])
+    assert set(loads) == {top / fn for fn in expected}
+
+def test_filters_combine(map_file, monkeypatch, top):
+    loads = parse(map_file, monkeypatch, address_ranges=[(0, 0x100)], paths=["*/gc.o"])
+    assert loads == {top / "build/gc.o": {".text.gc_collect_with_a_long_name"}}
+
+@pytest.fixture
+def fake_inputs(monkeypatch):
+    """Stand in for object files. Each one defines a single node."""
+    defines = {}
+    loaded = []
+    def load_input(fn, members, discarded, keep, graph):
+        loaded.append(fn)
+        key, node = defines[fn]
+        graph.add_node(node)
+        elf_symbol_graph.register_node_name(key, node)
+    monkeypatch.setattr(elf_symbol_graph, "load_input", load_input)
+    return defines, loaded
+
+def test_ingest_only_changed_inputs(fake_inputs):
+    defines, loaded = fake_inputs
+    defines["a.o"] = (("a", 4), "a")
+    defines["b.o"] = (("b", 4), "b")
+    loads = [("a.o", None, set(), None), ("b.o", None, set(), None)]
+    cache = {}
+    ingest_inputs(loads, {"a.o": 1, "b.o": 1}, cache)
+    ingest_inputs(loads, {"a.o": 1, "b.o": 2}, cache)
+    assert loaded == ["a.o", "b.o", "b.o"]
+
+    ingest_inputs(loads[:1], {"a.o": 1}, cache)
+    assert set(cache) == {"a.o"}
+
+def test_merge_inputs(fake_inputs):
+    defines, _ = fake_inputs
+    defines["a.o"] = (("helper", 4), "a.o:helper")
+    defines["b.o"] = (("helper", 4), "b.o:helper")
+    defines["c.o"] = (("main", 8), "main")
+    loads = [(fn, None, set(), None) for fn in ("a.o", "b.o", "c.o")]
+    cache = {}
+    ingest_inputs(loads, {"a.o": 1, "b.o": 1, "c.o": 1}, cache)
+
+    graph = merge_inputs(loads, cache)
+    assert set(graph.nodes) == {"a.o:helper", "b.o:helper", "main"}
+    assert symbol_to_node_name == {("helper", 4): None, ("main", 8): "main"}
+
+    # Without the clash the name resolves again.
+    graph = merge_inputs(loads[:1], cache)
+    assert symbol_to_node_name == {("helper", 4): "a.o:helper"}
+
+@pytest.fixture
+def gcc(tmp_path):
+    """Compile C snippets into objects and link them without a libc."""
+    if not shutil.which("gcc"):
+        pytest.skip("needs gcc")
+    def compile(name, source):
+        c = tmp_path / (name + ".c")
+        c.write_text(source)
+        o = tmp_path / (name + ".o")
+        subprocess.run(["gcc", "-c", "-O0", "-ffunction-sections", "-fdata-sections", "-fcommon",
+                        "-fno-pie", "-fno-asynchronous-unwind-tables", str(c), "-o", str(o)], check=True)
+        return o
+    def link(*objects):
+        elf = tmp_path / "firmware.elf"
+        subprocess.run(["gcc", "-nostdlib", "-no-pie", "-static", "-o", str(elf), *map(str, objects)], check=True)
+        return elf
+    return compile, link
+
+KEEP_SOURCE = """\
+int main(void) { return 0; }
+int caller(void) { return main(); }
+int unrelated(void) { return 3; }
+int common_var;
+"""
+
+def load_object(path, keep=None):
+    graph = nx.DiGraph()
+    with open(path, "rb") as f:
+        process_object_file(f, str(path), graph, keep=keep)
+    return graph
+
+def test_keep_incoming_relocation(gcc):
+    compile, _ = gcc
+    graph = load_object(compile("keep", KEEP_SOURCE), keep={".text.main"})
+    assert graph.has_edge("caller", "main")
+    assert set(graph.nodes) == {"caller", "main"}
+
+def test_keep_common(gcc):
+    compile, _ = gcc
+    o = compile("keep", KEEP_SOURCE)
+    assert set(load_object(o, keep={"COMMON"}).nodes) == {"common_var"}
+
+    graph = load_object(o)
+    assert {"caller", "main", "unrelated", "common_var"} <= set(graph.nodes)
+    assert "section" not in graph.nodes["common_var"]
+
+def test_elf_conflict_with_filtered_object(gcc):
+    compile, link = gcc
+    x = compile("x", "static int helper[4] = {1, 2, 3, 4};\nint x_get(int i) { return helper[i]; }\n")
+    y = compile("y", "static int helper[4] = {5, 6, 7, 8};\nint y_get(int i) { return helper[i]; }\n")
+    start = compile("start", "int x_get(int); int y_get(int);\nvoid _start(void) { x_get(1); y_get(2); for(;;); }\n")
+    elf = link(start, x, y)
+
+    # Only x.o is ingested so its helper is the only one registered.
+    graph = load_object(x)
+    process_elf_file(str(elf), graph, Filters(paths=["*/x.o"]))
+    assert "address" not in graph.nodes[f"{x}:helper"]
+    assert "address" in graph.nodes["x_get"]